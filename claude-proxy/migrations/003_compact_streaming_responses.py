@@ -9,83 +9,135 @@ New responses are automatically compacted on insert, so this migration only
 needs to run once to convert historical data.
 """
 
-import json
-from datetime import datetime
+import asyncio
+import logging
+import multiprocessing
+import os
+import pathlib
+import re
+import site
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
 
+import orjson
 
-def compact_streaming_response(raw_body: str) -> str:
+log = logging.getLogger(__name__)
+
+# Matches the payload of each non-empty SSE "data:" line. Lines may end in \n,
+# \r\n or a bare \r, and MULTILINE's ^ only matches after \n.
+_SSE_DATA_RE = re.compile(rb"(?:^|(?<=\r))[ \t]*data:[ \t]*(\S[^\r\n]*)", re.MULTILINE)
+
+# Number of rows read and handed to the process pool at a time
+COMPACT_BATCH_SIZE = 100
+
+# Number of rows written per transaction
+UPDATE_BATCH_SIZE = 1000
+
+# Worker processes used for compaction; half the cores, leaving the rest to the
+# proxy, which keeps serving while migrations run in the background
+COMPACT_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+
+def compact_streaming_response(raw_body: bytes, compacted_at: str) -> bytes:
     """
     Compact a Server-Sent Events (SSE) streaming response into a single JSON response.
+
+    Works on the UTF-8 bytes of the body, which orjson parses and produces directly.
+    compacted_at is the ISO 8601 timestamp recorded in the "_compacted" block.
     """
-    if not raw_body or not raw_body.strip().startswith("event:"):
+    if not raw_body or not raw_body.lstrip().startswith(b"event:"):
         return raw_body
 
-    chunks = []
+    chunk_count = 0
     content_parts = []
+    append_content = content_parts.append
     metadata = {}
     usage = {}
 
-    for line in raw_body.split("\n"):
-        line = line.strip()
-        if not line.startswith("data:"):
+    for match in _SSE_DATA_RE.finditer(raw_body):
+        data_str = match.group(1)
+        if data_str == b"[DONE]":
             continue
 
-        data_str = line[5:].strip()
-        if not data_str or data_str == "[DONE]":
+        try:
+            chunk = orjson.loads(data_str)
+        except orjson.JSONDecodeError:
             continue
+        chunk_count += 1
 
+        # Events come from a known API, so fields are indexed directly and an
+        # event missing one of them or shaped differently is skipped as a whole
         try:
-            chunk = json.loads(data_str)
-            chunks.append(chunk)
+            chunk_type = chunk.get("type")
+
+            # Extract content from content_block_delta events (the bulk of the stream)
+            if chunk_type == "content_block_delta":
+                delta = chunk["delta"]
+                delta_type = delta["type"]
+                if delta_type == "text_delta":
+                    append_content(delta["text"])
+                elif delta_type == "thinking_delta":
+                    append_content(delta["thinking"])
 
             # Extract metadata from first chunk
-            if not metadata and chunk.get("type") == "message_start":
-                msg = chunk.get("message", {})
+            elif chunk_type == "message_start" and not metadata:
+                msg = chunk["message"]
                 metadata = {
-                    "id": msg.get("id"),
+                    "id": msg["id"],
                     "type": "message",
-                    "role": msg.get("role"),
-                    "model": msg.get("model"),
-                    "stop_reason": msg.get("stop_reason"),
-                    "stop_sequence": msg.get("stop_sequence"),
+                    "role": msg["role"],
+                    "model": msg["model"],
+                    "stop_reason": msg["stop_reason"],
+                    "stop_sequence": msg["stop_sequence"],
                 }
-                if msg.get("usage"):
-                    usage = msg.get("usage", {})
-
-            # Extract content from content_block_delta events
-            if chunk.get("type") == "content_block_delta":
-                delta = chunk.get("delta", {})
-                if delta.get("type") == "text_delta":
-                    content_parts.append(delta.get("text", ""))
-                elif delta.get("type") == "thinking_delta":
-                    content_parts.append(delta.get("thinking", ""))
+                usage.update(msg["usage"])
 
             # Extract finish reason and final usage from message_delta
-            if chunk.get("type") == "message_delta":
-                delta = chunk.get("delta", {})
-                if delta.get("stop_reason"):
-                    metadata["stop_reason"] = delta.get("stop_reason")
-                if chunk.get("usage"):
-                    usage.update(chunk.get("usage", {}))
-
-        except json.JSONDecodeError:
+            elif chunk_type == "message_delta":
+                stop_reason = chunk["delta"]["stop_reason"]
+                if stop_reason:
+                    metadata["stop_reason"] = stop_reason
+                usage.update(chunk["usage"])
+        except (KeyError, TypeError, AttributeError, ValueError):
             continue
 
-    if not chunks:
+    if not chunk_count:
         return raw_body
 
-    # Build compacted response
-    compacted = {
-        **metadata,
-        "content": [{"type": "text", "text": "".join(content_parts)}],
-        "usage": usage,
-        "_compacted": {
-            "original_chunks": len(chunks),
-            "compacted_at": datetime.utcnow().isoformat()
-        }
+    # Build compacted response on top of the metadata, keeping its keys first
+    compacted = metadata
+    compacted["content"] = [{"type": "text", "text": "".join(content_parts)}]
+    compacted["usage"] = usage
+    compacted["_compacted"] = {
+        "original_chunks": chunk_count,
+        "compacted_at": compacted_at
     }
 
-    return json.dumps(compacted)
+    return orjson.dumps(compacted)
+
+
+def compact_row(row: tuple, compacted_at: str) -> tuple:
+    """
+    Compact a single (id, response_body) row in a worker process.
+
+    Returns:
+        (id, compacted_body, original_size, compacted_size), with compacted_body
+        set to None when the body was left unchanged
+    """
+    row_id, response_body = row
+    try:
+        compacted = compact_streaming_response(response_body, compacted_at)
+    except Exception:
+        # Keep a body that cannot be compacted rather than failing the migration
+        return row_id, None, 0, 0
+    if compacted is response_body:
+        return row_id, None, 0, 0
+    return (
+        row_id,
+        compacted,
+        len(response_body),
+        len(compacted),
+    )
 
 
 def format_bytes(size: int) -> str:
@@ -104,57 +156,129 @@ async def migrate(db):
     Args:
         db: aiosqlite database connection
     """
-    # Find rows with streaming responses (starting with "event:")
-    cursor = await db.execute("""
-        SELECT id, response_body
-        FROM request_logs
-        WHERE response_body LIKE 'event:%'
-    """)
+    # Avoid an fsync per statement and keep temporary b-trees off disk
+    await db.execute("PRAGMA journal_mode=WAL")
+    await db.execute("PRAGMA synchronous=NORMAL")
+    await db.execute("PRAGMA temp_store=MEMORY")
 
-    rows = await cursor.fetchall()
-    total_rows = len(rows)
+    migrated_count = await compact_rows(db)
+
+    if migrated_count > 0:
+        # A full VACUUM rewrites the whole file under an exclusive lock, which can
+        # take minutes on a large database, so it is opt-in. Otherwise the freed
+        # pages are reused by new rows.
+        if os.getenv("MIGRATION_VACUUM") == "1":
+            log.info("    Running VACUUM to reclaim disk space...")
+            await db.execute("VACUUM")
+            log.info("    VACUUM complete")
+        else:
+            log.info("    Skipped VACUUM (set MIGRATION_VACUUM=1 to reclaim all disk space)")
+
+
+async def compact_rows(db) -> int:
+    """
+    Compact every streaming response and log a summary.
+
+    Returns:
+        Number of rows that were rewritten
+    """
+    # Compares only the first bytes of each body. An index on this expression
+    # would not help: building it reads every body under the write lock, and the
+    # id-keyset pages below already visit each row once.
+    where_clause = "WHERE substr(response_body, 1, 6) = 'event:'"
+
+    cursor = await db.execute(f"SELECT COUNT(*) FROM request_logs {where_clause}")
+    (total_rows,) = await cursor.fetchone()
 
     if total_rows == 0:
-        print("    No streaming responses found to compact")
-        return
+        log.info("    No streaming responses found to compact")
+        return 0
 
-    print(f"    Found {total_rows} streaming response(s) to compact")
+    log.info("    Found %d streaming response(s) to compact", total_rows)
 
     total_original_bytes = 0
     total_compacted_bytes = 0
     migrated_count = 0
+    updates = []
+    # One UTC timestamp for the whole run instead of formatting one per row
+    compacted_at = datetime.now(timezone.utc).replace(tzinfo=None).isoformat()
 
-    for row_id, response_body in rows:
-        if not response_body:
-            continue
-
-        original_size = len(response_body.encode('utf-8'))
-        compacted = compact_streaming_response(response_body)
-        compacted_size = len(compacted.encode('utf-8'))
-
-        # Only update if actually compacted
-        if compacted != response_body:
+    async def flush_updates():
+        # Short write transactions let the proxy keep logging while this runs
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            await db.executemany(
+                "UPDATE request_logs SET response_body = CAST(? AS TEXT) WHERE id = ?",
+                updates
+            )
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        updates.clear()
+
+    async def write_results(pending):
+        nonlocal total_original_bytes, total_compacted_bytes, migrated_count
+        for row_id, compacted, original_size, compacted_size in await pending:
+            # Only update if actually compacted
+            if compacted is None:
+                continue
             total_original_bytes += original_size
             total_compacted_bytes += compacted_size
             migrated_count += 1
-
-            await db.execute(
-                "UPDATE request_logs SET response_body = ? WHERE id = ?",
-                (compacted, row_id)
+            updates.append((compacted, row_id))
+            if len(updates) >= UPDATE_BATCH_SIZE:
+                await flush_updates()
+
+    loop = asyncio.get_running_loop()
+    # Workers are spawned rather than forked from the proxy, whose threads (e.g.
+    # the aiosqlite connection) make forking unsafe. They import this module by
+    # name, so make the migrations directory importable.
+    with ProcessPoolExecutor(
+        max_workers=COMPACT_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=site.addsitedir,
+        initargs=(str(pathlib.Path(__file__).parent),)
+    ) as pool:
+        def submit(batch):
+            return asyncio.gather(*(
+                loop.run_in_executor(pool, compact_row, row, compacted_at) for row in batch
+            ))
+
+        # Read rows with streaming responses (starting with "event:") a page at a
+        # time by id, instead of loading every body into memory or holding a read
+        # transaction open while updates are committed. Each page is compacted in
+        # the process pool while the results of the previous page are written.
+        # Bodies travel as raw UTF-8 bytes and are stored back as TEXT.
+        pending = None
+        last_id = 0
+        while True:
+            cursor = await db.execute(
+                f"SELECT id, CAST(response_body AS BLOB) FROM request_logs {where_clause} "
+                "AND id > ? ORDER BY id LIMIT ?",
+                (last_id, COMPACT_BATCH_SIZE)
             )
-
-    await db.commit()
+            batch = await cursor.fetchall()
+            next_pending = submit(batch) if batch else None
+            if pending is not None:
+                await write_results(pending)
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            pending = next_pending
+
+        if updates:
+            await flush_updates()
 
     # Summary
     if migrated_count > 0:
         total_reduction = total_original_bytes - total_compacted_bytes
         reduction_pct = (total_reduction / total_original_bytes) * 100
-        print(f"    Compacted {migrated_count} responses")
-        print(f"    Space saved: {format_bytes(total_reduction)} ({reduction_pct:.1f}% reduction)")
-
-        # Run VACUUM to reclaim disk space
-        print("    Running VACUUM to reclaim disk space...")
-        await db.execute("VACUUM")
-        print("    VACUUM complete")
+        log.info("    Compacted %d responses", migrated_count)
+        log.info(
+            "    Space saved: %s (%.1f%% reduction)", format_bytes(total_reduction), reduction_pct
+        )
     else:
-        print("    No responses needed compaction")
+        log.info("    No responses needed compaction")
+
+    return migrated_count
@@ -4,24 +4,141 @@ Minimalistic logging proxy for Anthropic API requests.
 Receives HTTP requests, logs them to SQLite, forwards to Anthropic API as HTTPS.
 """
 import asyncio
-import json
+import logging
+import logging.handlers
 import os
+import queue
+import re
 import sqlite3
-from datetime import datetime
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 import aiohttp
 from aiohttp import web
 import aiosqlite
+from multidict import CIMultiDict
+import orjson
 
 
 # Configuration from environment variables
 PROXY_PORT = int(os.getenv("PROXY_PORT", "8080"))
 TARGET_API_URL = os.getenv("TARGET_API_URL", "https://api.anthropic.com")
 DB_PATH = os.getenv("DB_PATH", "/data/requests.db")
+# async: migrate in the background while serving, sync: migrate before serving,
+# skip: only make sure the request_logs table exists
+MIGRATION_MODE = os.getenv("MIGRATION_MODE", "async")
+# Maximum size of each upstream body chunk relayed to the client. Reads return as
+# soon as any data is available, so this does not delay streamed events.
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", str(64 * 1024)))
+
+log = logging.getLogger("proxy")
+
+# Matches the payload of each non-empty SSE "data:" line. Lines may end in \n,
+# \r\n or a bare \r, and MULTILINE's ^ only matches after \n.
+_SSE_DATA_RE = re.compile(rb"(?:^|(?<=\r))[ \t]*data:[ \t]*(\S[^\r\n]*)", re.MULTILINE)
+
+# Largest event stream also kept as received, so that a stream which cannot be
+# compacted is still logged in full
+SSE_RAW_BODY_LIMIT = 1024 * 1024
+
+# Hop-by-hop headers that are not forwarded (lowercase)
+_HOP_BY_HOP_REQUEST_HEADERS = frozenset({
+    'host', 'connection', 'keep-alive', 'transfer-encoding',
+})
+_HOP_BY_HOP_RESPONSE_HEADERS = frozenset({
+    'connection', 'keep-alive', 'transfer-encoding', 'upgrade',
+    'proxy-authenticate', 'proxy-authorization', 'te', 'trailers',
+})
+
+# Upstream body headers that no longer apply once the body is relayed (lowercase)
+_RELAYED_BODY_HEADERS = frozenset({'content-length', 'content-encoding'})
+
+# Maximum number of log records written per transaction
+LOG_BATCH_SIZE = 500
+
+# Seconds the log writer waits for more records before flushing a batch
+LOG_FLUSH_INTERVAL = 0.05
+
+# Maximum number of log records waiting to be written
+LOG_QUEUE_SIZE = 10_000
+
+# Insert statement for one log record. Header JSON is produced by orjson and
+# stored as-is; request bodies are stored as JSON when valid and wrapped otherwise.
+_INSERT_LOG_SQL = """
+    INSERT INTO request_logs
+    (timestamp, method, path, target_url, request_headers, request_body,
+     response_status, response_headers, response_body, duration_ms)
+    VALUES (?1, ?2, ?3, ?4, ?5,
+            CASE WHEN ?6 IS NULL OR json_valid(?6) THEN ?6
+                 ELSE json_object('raw', ?6) END,
+            ?7, ?8, ?9, ?10)
+"""
+
+# Table recording which migrations have been applied
+_CREATE_MIGRATIONS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        filename TEXT PRIMARY KEY,
+        applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+# Maximum number of background log_request() calls in flight
+MAX_PENDING_LOGS = 1000
+
+# Seconds between PRAGMA optimize runs on the log database
+DB_OPTIMIZE_INTERVAL = 15 * 60
+
+
+# Whole second and its formatted date/time of the last utc_timestamp() call
+_timestamp_second = None
+_timestamp_prefix = ""
 
 
-def compact_streaming_response(raw_body: str) -> str:
+def utc_timestamp() -> str:
+    """
+    Return the current UTC time in ISO 8601 format, e.g. 2025-01-31T12:34:56.789012.
+
+    Formatting a datetime on every call is comparatively slow, so the date/time part
+    is only rebuilt when the second changes and the microseconds are appended.
+    """
+    global _timestamp_second, _timestamp_prefix
+    second, nanoseconds = divmod(time.time_ns(), 1_000_000_000)
+    if second != _timestamp_second:
+        _timestamp_prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+        _timestamp_second = second
+    return f"{_timestamp_prefix}.{nanoseconds // 1000:06d}"
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """
+    Send log output through a queue to a stdout handler on a background thread.
+
+    Handlers only enqueue records, so the event loop never blocks on console I/O.
+    The returned listener must be stopped on exit to flush remaining records.
+    """
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        log_queue, logging.StreamHandler(sys.stdout)
+    )
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(message)s",
+        handlers=[logging.handlers.QueueHandler(log_queue)]
+    )
+    listener.start()
+    return listener
+
+
+def headers_json(headers) -> str:
+    """Serialize request or response headers to a JSON object string."""
+    # Header names are multidict istr instances, which orjson only accepts
+    # as keys with OPT_NON_STR_KEYS
+    return orjson.dumps(dict(headers), option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+def compact_streaming_response(raw_body: bytes) -> Optional[str]:
     """
     Compact a Server-Sent Events (SSE) streaming response into a single JSON response.
 
@@ -33,79 +150,175 @@ def compact_streaming_response(raw_body: str) -> str:
         raw_body: The raw SSE response body with multiple data: lines
 
     Returns:
-        A compacted JSON string, or the original body if not a streaming response
+        A compacted JSON string, or None if the body is not a streaming response
+    """
+    if not raw_body or not raw_body.lstrip().startswith(b"event:"):
+        return None
+
+    compactor = SSECompactor()
+    compactor.feed(raw_body)
+    return compactor.finalize()
+
+
+class SSECompactor:
+    """
+    Incrementally compact a Server-Sent Events (SSE) streaming response.
+
+    Body chunks are fed in as they arrive from the upstream API and every complete
+    'data:' line is parsed right away, so the stream never has to be re-parsed.
+    finalize() returns the same compacted JSON response as
+    compact_streaming_response(). Streams up to SSE_RAW_BODY_LIMIT bytes are also
+    kept as received, for raw_body() to return when they cannot be compacted.
     """
-    if not raw_body or not raw_body.strip().startswith("event:"):
-        return raw_body
 
-    chunks = []
-    content_parts = []
-    metadata = {}
-    usage = {}
-    finish_reason = None
+    def __init__(self):
+        self.size = 0
+        self.chunk_count = 0
+        # Chunks of a line that has not been terminated yet
+        self._pending = []
+        self._content_parts = []
+        self._metadata = {}
+        self._usage = {}
+        # Chunks as received, or None once the stream exceeds SSE_RAW_BODY_LIMIT
+        self._raw = []
+        # Set once compaction has failed; only the size is tracked from then on
+        self.failed = False
+
+    def feed(self, data: bytes):
+        """
+        Consume the next chunk of the response body.
+
+        Never raises, so a malformed stream cannot interrupt relaying it; if the
+        stream cannot be compacted, finalize() returns None instead.
+        """
+        if self._raw is not None:
+            if self.size + len(data) <= SSE_RAW_BODY_LIMIT:
+                self._raw.append(data)
+            else:
+                self._raw = None
+        self._safe_feed(data)
+
+    def _safe_feed(self, data: bytes):
+        if self.failed:
+            self.size += len(data)
+            return
+        try:
+            self._feed(data)
+        except Exception as e:
+            log.warning("✗ Could not compact event stream, logging it uncompacted: %s", e)
+            self.failed = True
+
+    def _feed(self, data: bytes):
+        self.size += len(data)
+
+        # Only complete lines are parsed; a trailing partial line is carried over.
+        # Chunks without a line break are only collected, so a long line arriving
+        # in many chunks is joined once instead of being re-concatenated each time.
+        end = max(data.rfind(b"\n"), data.rfind(b"\r")) + 1
+        if not end:
+            self._pending.append(data)
+            return
+        if self._pending:
+            self._pending.append(data)
+            buffer = b"".join(self._pending)
+            end += len(buffer) - len(data)
+        else:
+            buffer = data
+        self._pending = [buffer[end:]] if end < len(buffer) else []
+
+        append_content = self._content_parts.append
+        usage = self._usage
+        chunk_count = self.chunk_count
+        for match in _SSE_DATA_RE.finditer(buffer, 0, end):
+            data_str = match.group(1)
+            if data_str == b"[DONE]":
+                continue
+
+            try:
+                chunk = orjson.loads(data_str)
+            except orjson.JSONDecodeError:
+                continue
+            chunk_count += 1
+
+            # Events come from a known API, so fields are indexed directly and an
+            # event missing one of them or shaped differently is skipped as a whole
+            try:
+                chunk_type = chunk.get("type")
+
+                # Extract content from content_block_delta events (the bulk of the stream)
+                if chunk_type == "content_block_delta":
+                    delta = chunk["delta"]
+                    delta_type = delta["type"]
+                    if delta_type == "text_delta":
+                        append_content(delta["text"])
+                    elif delta_type == "thinking_delta":
+                        append_content(delta["thinking"])
+
+                # Extract metadata from first chunk
+                elif chunk_type == "message_start" and not self._metadata:
+                    msg = chunk["message"]
+                    self._metadata = {
+                        "id": msg["id"],
+                        "type": "message",
+                        "role": msg["role"],
+                        "model": msg["model"],
+                        "stop_reason": msg["stop_reason"],
+                        "stop_sequence": msg["stop_sequence"],
+                    }
+                    usage.update(msg["usage"])
+
+                # Extract finish reason and final usage from message_delta
+                elif chunk_type == "message_delta":
+                    stop_reason = chunk["delta"]["stop_reason"]
+                    if stop_reason:
+                        self._metadata["stop_reason"] = stop_reason
+                    usage.update(chunk["usage"])
+            except (KeyError, TypeError, AttributeError, ValueError):
+                continue
+
+        self.chunk_count = chunk_count
+
+    def finalize(self) -> Optional[str]:
+        """
+        Build the compacted response from everything fed so far.
 
-    for line in raw_body.split("\n"):
-        line = line.strip()
-        if not line.startswith("data:"):
-            continue
+        Returns:
+            A compacted JSON string, or None if no data chunks could be parsed or
+            compaction failed
+        """
+        if self._pending:
+            # Terminate a final line that had no trailing newline
+            self.size -= 1
+            self._safe_feed(b"\n")
 
-        data_str = line[5:].strip()
-        if not data_str or data_str == "[DONE]":
-            continue
+        if self.failed or not self.chunk_count:
+            return None
 
+        # Build compacted response on top of the metadata, keeping its keys first
         try:
-            chunk = json.loads(data_str)
-            chunks.append(chunk)
-
-            # Extract metadata from first chunk
-            if not metadata and chunk.get("type") == "message_start":
-                msg = chunk.get("message", {})
-                metadata = {
-                    "id": msg.get("id"),
-                    "type": "message",
-                    "role": msg.get("role"),
-                    "model": msg.get("model"),
-                    "stop_reason": msg.get("stop_reason"),
-                    "stop_sequence": msg.get("stop_sequence"),
-                }
-                if msg.get("usage"):
-                    usage = msg.get("usage", {})
-
-            # Extract content from content_block_delta events
-            if chunk.get("type") == "content_block_delta":
-                delta = chunk.get("delta", {})
-                if delta.get("type") == "text_delta":
-                    content_parts.append(delta.get("text", ""))
-                elif delta.get("type") == "thinking_delta":
-                    content_parts.append(delta.get("thinking", ""))
-
-            # Extract finish reason and final usage from message_delta
-            if chunk.get("type") == "message_delta":
-                delta = chunk.get("delta", {})
-                if delta.get("stop_reason"):
-                    finish_reason = delta.get("stop_reason")
-                    metadata["stop_reason"] = finish_reason
-                if chunk.get("usage"):
-                    usage.update(chunk.get("usage", {}))
-
-        except json.JSONDecodeError:
-            continue
-
-    if not chunks:
-        return raw_body
-
-    # Build compacted response
-    compacted = {
-        **metadata,
-        "content": [{"type": "text", "text": "".join(content_parts)}],
-        "usage": usage,
-        "_compacted": {
-            "original_chunks": len(chunks),
-            "compacted_at": datetime.utcnow().isoformat()
-        }
-    }
-
-    return json.dumps(compacted)
+            compacted = self._metadata
+            compacted["content"] = [{"type": "text", "text": "".join(self._content_parts)}]
+            compacted["usage"] = self._usage
+            compacted["_compacted"] = {
+                "original_chunks": self.chunk_count,
+                "compacted_at": utc_timestamp()
+            }
+            return orjson.dumps(compacted).decode()
+        except Exception as e:
+            log.warning("✗ Could not compact event stream, logging it uncompacted: %s", e)
+            self.failed = True
+            return None
+
+    def raw_body(self) -> Optional[bytes]:
+        """
+        Return the stream as received.
+
+        Returns:
+            The raw body, or None if it was larger than SSE_RAW_BODY_LIMIT
+        """
+        if self._raw is None:
+            return None
+        return b"".join(self._raw)
 
 
 class ProxyLogger:
@@ -113,6 +326,57 @@ class ProxyLogger:
 
     def __init__(self, db_path: str):
         self.db_path = db_path
+        # Log records are written with plain sqlite3 on a single dedicated thread,
+        # which owns the connection; migrations use their own aiosqlite connection
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+        self._flush_task: Optional[asyncio.Task] = None
+        self._optimize_task: Optional[asyncio.Task] = None
+        self._db_dir_ready = False
+
+    async def connect(self):
+        """Open the writer connection and start flushing queued log records."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._connect_blocking)
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        self._optimize_task = asyncio.create_task(self._optimize_loop())
+
+    async def close(self):
+        """Flush pending log records and close the writer connection."""
+        if self._flush_task is not None:
+            await self._queue.join()
+            self._flush_task.cancel()
+            self._flush_task = None
+        if self._optimize_task is not None:
+            self._optimize_task.cancel()
+            self._optimize_task = None
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._close_blocking)
+        self._executor.shutdown()
+
+    def _connect_blocking(self):
+        # Autocommit mode; transactions are managed explicitly per batch. The
+        # longer busy timeout waits out write locks held by background migrations.
+        self._conn = sqlite3.connect(self.db_path, isolation_level=None, timeout=30)
+        # WAL lets readers (e.g. Datasette) run alongside the writer, and with
+        # synchronous=NORMAL commits no longer fsync on every transaction
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # 64 MB page cache, 128 MB memory-mapped reads, temporary tables in memory
+        self._conn.execute("PRAGMA cache_size=-64000")
+        self._conn.execute("PRAGMA mmap_size=134217728")
+        self._conn.execute("PRAGMA temp_store=MEMORY")
+
+    def _optimize_blocking(self):
+        if self._conn is not None:
+            self._conn.execute("PRAGMA optimize")
+
+    def _close_blocking(self):
+        if self._conn is not None:
+            self._optimize_blocking()
+            self._conn.close()
+            self._conn = None
 
     async def run_migrations(self, db):
         """Run all migration files (SQL and Python) in order."""
@@ -121,20 +385,25 @@ class ProxyLogger:
 
         migrations_dir = pathlib.Path(__file__).parent / "migrations"
         if not migrations_dir.exists():
-            print(f"No migrations directory found at {migrations_dir}")
+            log.warning("No migrations directory found at %s", migrations_dir)
             return
 
         # Create migrations tracking table
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS schema_migrations (
-                filename TEXT PRIMARY KEY,
-                applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+        await db.execute(_CREATE_MIGRATIONS_TABLE_SQL)
         await db.commit()
 
-        # Get list of already applied migrations
-        cursor = await db.execute("SELECT filename FROM schema_migrations")
+        # Find and sort all migration files (both .sql and .py)
+        sql_files = list(migrations_dir.glob("*.sql"))
+        py_files = list(migrations_dir.glob("*.py"))
+        migration_files = sorted(sql_files + py_files, key=lambda f: f.name)
+
+        # Look up which of them were already applied in a single query
+        filenames = [f.name for f in migration_files]
+        cursor = await db.execute(
+            "SELECT filename FROM schema_migrations WHERE filename IN "
+            f"({', '.join('?' * len(filenames))})",
+            filenames
+        )
         applied = {row[0] for row in await cursor.fetchall()}
 
         # Check if request_logs table already exists (created by old Python code)
@@ -145,84 +414,131 @@ class ProxyLogger:
 
         # If table exists but 000_initial.sql wasn't tracked, mark it as applied
         if table_exists and "000_initial.sql" not in applied:
-            print("  ✓ Migration 000_initial.sql already applied (table exists from previous setup)")
+            log.info("  ✓ Migration 000_initial.sql already applied (table exists from previous setup)")
             await db.execute(
-                "INSERT INTO schema_migrations (filename) VALUES (?)",
+                "INSERT OR IGNORE INTO schema_migrations (filename) VALUES (?)",
                 ("000_initial.sql",)
             )
             await db.commit()
             applied.add("000_initial.sql")
 
-        # Find and sort all migration files (both .sql and .py)
-        sql_files = list(migrations_dir.glob("*.sql"))
-        py_files = list(migrations_dir.glob("*.py"))
-        migration_files = sorted(sql_files + py_files, key=lambda f: f.name)
-
         for migration_file in migration_files:
             filename = migration_file.name
             if filename in applied:
-                # Skip printing for 000_initial.sql if we just auto-marked it above
+                # Skip the message for 000_initial.sql if we just auto-marked it above
                 if not (table_exists and filename == "000_initial.sql"):
-                    print(f"  ✓ Migration {filename} already applied")
+                    log.info("  ✓ Migration %s already applied", filename)
                 continue
 
-            print(f"  → Applying migration {filename}...")
+            log.info("  → Applying migration %s...", filename)
             try:
                 if filename.endswith(".sql"):
-                    # SQL migration
+                    # SQL migration, applied and recorded in one transaction.
+                    # executescript() commits before it runs, so the script opens
+                    # the transaction and leaves it open for the record below.
+                    # The extra ";" terminates a last statement that has none.
                     sql_content = migration_file.read_text()
-                    await db.executescript(sql_content)
+                    try:
+                        await db.executescript(f"BEGIN;\n{sql_content}\n;\n")
+                        await db.execute(
+                            "INSERT OR IGNORE INTO schema_migrations (filename) VALUES (?)",
+                            (filename,)
+                        )
+                        await db.commit()
+                    except Exception:
+                        await db.rollback()
+                        raise
                 elif filename.endswith(".py"):
                     # Python migration - must have an async migrate(db) function
                     spec = importlib.util.spec_from_file_location(
                         filename[:-3], migration_file
                     )
                     module = importlib.util.module_from_spec(spec)
+                    # Register the module so its functions can be pickled
+                    # (e.g. when a migration uses a process pool)
+                    sys.modules[spec.name] = module
                     spec.loader.exec_module(module)
                     if hasattr(module, "migrate"):
                         await module.migrate(db)
                     else:
-                        print(f"  ⚠ Migration {filename} has no migrate() function, skipping")
+                        log.warning("  ⚠ Migration %s has no migrate() function, skipping", filename)
                         continue
 
-                # Record the migration as applied
-                await db.execute(
-                    "INSERT INTO schema_migrations (filename) VALUES (?)",
-                    (filename,)
-                )
-                await db.commit()
-                print(f"  ✓ Migration {filename} applied successfully")
+                    # Record the migration as applied
+                    await db.execute(
+                        "INSERT OR IGNORE INTO schema_migrations (filename) VALUES (?)",
+                        (filename,)
+                    )
+                    await db.commit()
+                log.info("  ✓ Migration %s applied successfully", filename)
             except Exception as e:
-                print(f"  ✗ ERROR applying migration {filename}: {e}")
+                log.error("  ✗ ERROR applying migration %s: %s", filename, e)
                 raise
 
-    async def init_db(self):
-        """Initialize the database schema via migrations."""
+    def _ensure_db_dir(self):
+        """Ensure the database directory exists."""
         import pathlib
 
-        # Ensure database directory exists
+        if self._db_dir_ready:
+            return
         db_dir = pathlib.Path(self.db_path).parent
         db_dir.mkdir(parents=True, exist_ok=True)
-        print(f"Database directory: {db_dir}")
+        log.info("Database directory: %s", db_dir)
+        self._db_dir_ready = True
+
+    async def ensure_schema(self):
+        """
+        Create the request_logs table if it does not exist yet.
+
+        This is fast regardless of database size, so requests can be logged while
+        the remaining migrations run in the background.
+        """
+        import pathlib
+
+        self._ensure_db_dir()
+        initial_migration = pathlib.Path(__file__).parent / "migrations" / "000_initial.sql"
+        async with aiosqlite.connect(self.db_path) as db:
+            cursor = await db.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name='request_logs'"
+            )
+            if await cursor.fetchone() is None:
+                # Record the initial migration along with the table it creates, so
+                # run_migrations() does not take the table for a previous setup's
+                await db.execute(_CREATE_MIGRATIONS_TABLE_SQL)
+                try:
+                    await db.executescript(f"BEGIN;\n{initial_migration.read_text()}\n;\n")
+                    await db.execute(
+                        "INSERT OR IGNORE INTO schema_migrations (filename) VALUES (?)",
+                        (initial_migration.name,)
+                    )
+                    await db.commit()
+                except Exception:
+                    await db.rollback()
+                    raise
+        log.info("✓ Table 'request_logs' ready at %s", self.db_path)
+
+    async def init_db(self):
+        """Initialize the database schema via migrations."""
+        self._ensure_db_dir()
 
         try:
             async with aiosqlite.connect(self.db_path) as db:
                 # Run all migrations (including initial schema creation)
-                print("Running database migrations...")
+                log.info("Running database migrations...")
                 await self.run_migrations(db)
-                print("✓ Migrations complete")
+                log.info("✓ Migrations complete")
 
                 # Verify table was created
                 cursor = await db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='request_logs'")
                 result = await cursor.fetchone()
                 if result:
-                    print(f"✓ Database initialized successfully at {self.db_path}")
-                    print(f"✓ Table 'request_logs' exists")
+                    log.info("✓ Database initialized successfully at %s", self.db_path)
+                    log.info("✓ Table 'request_logs' exists")
                 else:
-                    print(f"✗ ERROR: Table 'request_logs' was not created!")
+                    log.error("✗ ERROR: Table 'request_logs' was not created!")
 
         except Exception as e:
-            print(f"✗ ERROR initializing database: {e}")
+            log.error("✗ ERROR initializing database: %s", e)
             raise
 
     async def log_request(
@@ -230,154 +546,348 @@ class ProxyLogger:
         method: str,
         path: str,
         target_url: str,
-        request_headers: dict,
+        request_headers_json: str,
         request_body: Optional[str],
         response_status: int,
-        response_headers: dict,
+        response_headers_json: str,
         response_body: Optional[str],
         duration_ms: int
     ):
-        """Log a complete request/response cycle to SQLite."""
-        timestamp = datetime.utcnow().isoformat()
-
-        # Prepare JSON fields
-        request_headers_json = json.dumps(dict(request_headers))
-        response_headers_json = json.dumps(dict(response_headers))
+        """
+        Queue a complete request/response cycle to be written to SQLite.
+
+        Headers are passed already serialized with headers_json().
+        """
+        record = (
+            utc_timestamp(),
+            method,
+            path,
+            target_url,
+            request_headers_json,
+            # Validated by the INSERT statement, which wraps non-JSON bodies
+            request_body or None,
+            response_status,
+            response_headers_json,
+            response_body,
+            duration_ms
+        )
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            # The writer is falling behind; wait for room instead of letting
+            # queued bodies grow without bound
+            await self._queue.put(record)
+
+    async def _flush_loop(self):
+        """Write queued log records in batches, one transaction per batch."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            # Give concurrent requests a moment to queue up behind the first record
+            if self._queue.qsize() < LOG_BATCH_SIZE - 1:
+                await asyncio.sleep(LOG_FLUSH_INTERVAL)
+            while len(batch) < LOG_BATCH_SIZE and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
 
-        # Try to parse request_body as JSON, otherwise store as string in JSON
-        request_body_json = None
-        if request_body:
             try:
-                # If it's already valid JSON, parse and re-stringify to ensure proper formatting
-                parsed_body = json.loads(request_body)
-                request_body_json = json.dumps(parsed_body)
-            except json.JSONDecodeError:
-                # If not JSON, wrap the string value in a JSON object
-                request_body_json = json.dumps({"raw": request_body})
+                await loop.run_in_executor(self._executor, self._write_batch_blocking, batch)
+            except Exception as e:
+                log.error("✗ ERROR logging %d request(s) to database: %s", len(batch), e)
+                log.error("   Database path: %s", self.db_path)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _optimize_loop(self):
+        """Periodically refresh query planner statistics on the writer connection."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(DB_OPTIMIZE_INTERVAL)
+            try:
+                await loop.run_in_executor(self._executor, self._optimize_blocking)
+            except Exception as e:
+                log.error("✗ ERROR optimizing database: %s", e)
 
+    def _write_batch_blocking(self, batch: list):
+        conn = self._conn
+        conn.execute("BEGIN")
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute("""
-                    INSERT INTO request_logs
-                    (timestamp, method, path, target_url, request_headers, request_body,
-                     response_status, response_headers, response_body, duration_ms)
-                    VALUES (?, ?, ?, ?, json(?), json(?), ?, json(?), ?, ?)
-                """, (
-                    timestamp,
-                    method,
-                    path,
-                    target_url,
-                    request_headers_json,
-                    request_body_json,
-                    response_status,
-                    response_headers_json,
-                    response_body,
-                    duration_ms
-                ))
-                await db.commit()
-        except Exception as e:
-            print(f"✗ ERROR logging request to database: {e}")
-            print(f"   Database path: {self.db_path}")
-            print(f"   Request: {method} {path}")
+            conn.executemany(_INSERT_LOG_SQL, batch)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
             raise
 
 
-async def proxy_handler(request: web.Request) -> web.Response:
+def abort_response(request: web.Request):
+    """
+    Close the client connection of a response that cannot be completed.
+
+    The body is relayed without a Content-Length, so ending it normally would
+    present a truncated body as complete. Closing the connection before the final
+    chunk is written makes the client see an incomplete response instead.
+    """
+    if request.transport is not None:
+        request.transport.close()
+
+
+async def proxy_handler(request: web.Request) -> web.StreamResponse:
     """Handle incoming requests and forward them to target API."""
     logger: ProxyLogger = request.app['logger']
     target_api_url: str = request.app['target_api_url']
-    start_time = asyncio.get_event_loop().time()
+    start_time = time.perf_counter_ns()
 
     # Build target URL
     target_url = f"{target_api_url}{request.path_qs}"
 
-    # Read request body
+    # Read request body; it is forwarded as the exact bytes the client sent
     request_body = None
     if request.body_exists:
-        request_body = await request.text()
-
-    # Prepare headers for forwarding (remove hop-by-hop headers)
-    forward_headers = {
-        k: v for k, v in request.headers.items()
-        if k.lower() not in ('host', 'connection', 'keep-alive', 'transfer-encoding')
-    }
-
+        request_body = await request.read()
+
+    # Prepare headers for forwarding (remove hop-by-hop headers). A multidict
+    # keeps repeated headers, which a plain dict would collapse to one value.
+    forward_headers = CIMultiDict([
+        (k, v) for k, v in request.headers.items()
+        if k.lower() not in _HOP_BY_HOP_REQUEST_HEADERS
+    ])
+
+    # Request side of the log record
+    request_headers_json = headers_json(request.headers)
+    # Decoded for the log record only
+    request_body_text = (
+        request_body.decode('utf-8', errors='replace') if request_body else None
+    )
+
+    client_response = None
     try:
-        # Forward request to Anthropic API
-        async with aiohttp.ClientSession() as session:
-            async with session.request(
-                method=request.method,
-                url=target_url,
-                headers=forward_headers,
-                data=request_body,
-                allow_redirects=False
-            ) as response:
-                # Read response body
-                response_body = await response.read()
-
-                # Calculate duration
-                duration_ms = int((asyncio.get_event_loop().time() - start_time) * 1000)
-
-                # Prepare response headers (filter hop-by-hop headers)
-                response_headers = {
-                    k: v for k, v in response.headers.items()
-                    if k.lower() not in ('connection', 'keep-alive', 'transfer-encoding',
-                                        'upgrade', 'proxy-authenticate', 'proxy-authorization',
-                                        'te', 'trailers')
-                }
-
-                # Log to database (convert body to text for logging)
+        # Forward request to Anthropic API over the shared, pooled session
+        session: aiohttp.ClientSession = request.app['session']
+        async with session.request(
+            method=request.method,
+            url=target_url,
+            headers=forward_headers,
+            data=request_body,
+            allow_redirects=False
+        ) as response:
+            # Prepare response headers (filter hop-by-hop headers)
+            response_headers = CIMultiDict([
+                (k, v) for k, v in response.headers.items()
+                if k.lower() not in _HOP_BY_HOP_RESPONSE_HEADERS
+            ])
+
+            # The body is relayed decompressed and in chunks of unknown size, so
+            # let aiohttp frame it instead of forwarding the upstream length/encoding
+            client_response = web.StreamResponse(
+                status=response.status,
+                reason=response.reason,
+                headers=CIMultiDict([
+                    (k, v) for k, v in response_headers.items()
+                    if k.lower() not in _RELAYED_BODY_HEADERS
+                ])
+            )
+            await client_response.prepare(request)
+
+            # Stream the body to the client as it arrives. Streaming (SSE) responses
+            # are compacted on the fly; other bodies are kept as-is for logging.
+            # Whatever was received is logged even if the relay does not complete.
+            compactor = SSECompactor() if response.content_type == "text/event-stream" else None
+            response_chunks = []
+            client_disconnected = False
+            relay_error = None
+            cancelled = None
+            try:
+                async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    try:
+                        await client_response.write(chunk)
+                    except ConnectionError:
+                        # The client went away, e.g. it cancelled a generation
+                        client_disconnected = True
+                    if compactor is not None:
+                        compactor.feed(chunk)
+                    else:
+                        response_chunks.append(chunk)
+                    if client_disconnected:
+                        break
+                else:
+                    try:
+                        await client_response.write_eof()
+                    except ConnectionError:
+                        client_disconnected = True
+            except asyncio.CancelledError as e:
+                # With handler cancellation enabled, a client disconnect cancels
+                # the handler instead of failing the next write
+                client_disconnected = True
+                cancelled = e
+            except Exception as e:
+                # The upstream response broke off; the client gets it truncated
+                relay_error = e
+
+            # Calculate duration
+            duration_ms = (time.perf_counter_ns() - start_time) // 1_000_000
+
+            # Log to database (convert body to text for logging)
+            if compactor is not None:
+                response_body_text = compactor.finalize()
+                if response_body_text is None:
+                    # Store a stream that could not be compacted as received
+                    response_body = compactor.raw_body()
+                    if response_body is None:
+                        response_body_text = f"<event stream, {compactor.size} bytes>"
+            else:
+                # Joined once, rather than copied into a growing buffer per chunk
+                response_body = b"".join(response_chunks)
+                # Compact streaming responses to reduce database size
+                response_body_text = compact_streaming_response(response_body)
+            if response_body_text is None:
                 try:
                     response_body_text = response_body.decode('utf-8')
-                    # Compact streaming responses to reduce database size
-                    if response_body_text.strip().startswith("event:"):
-                        response_body_text = compact_streaming_response(response_body_text)
                 except:
                     response_body_text = f"<binary data, {len(response_body)} bytes>"
 
-                await logger.log_request(
-                    method=request.method,
-                    path=request.path_qs,
-                    target_url=target_url,
-                    request_headers=dict(request.headers),
-                    request_body=request_body,
-                    response_status=response.status,
-                    response_headers=response_headers,
-                    response_body=response_body_text,
-                    duration_ms=duration_ms
+            # Log in the background so the handler does not wait on the database.
+            # Only when MAX_PENDING_LOGS calls are already waiting on a full log
+            # queue does the handler wait for a slot, after the client has its response.
+            # A cancelled handler cannot wait, so its record is logged without a slot.
+            log_slots: asyncio.Semaphore = request.app['log_slots']
+            if cancelled is None:
+                await log_slots.acquire()
+            log_task = asyncio.create_task(logger.log_request(
+                method=request.method,
+                path=request.path_qs,
+                target_url=target_url,
+                request_headers_json=request_headers_json,
+                request_body=request_body_text,
+                response_status=response.status,
+                response_headers_json=headers_json(response_headers),
+                response_body=response_body_text,
+                duration_ms=duration_ms
+            ))
+            pending_logs: set = request.app['pending_logs']
+            pending_logs.add(log_task)
+            log_task.add_done_callback(pending_logs.discard)
+            if cancelled is None:
+                log_task.add_done_callback(lambda _: log_slots.release())
+
+            if relay_error is not None:
+                log.error(
+                    "✗ Upstream response for %s %s broke off after %dms: %s",
+                    request.method, request.path, duration_ms, relay_error
                 )
-
-                print(f"{request.method} {request.path} -> {response.status} ({duration_ms}ms)")
-
-                # Return response to client
-                return web.Response(
-                    status=response.status,
-                    headers=response_headers,
-                    body=response_body
+                abort_response(request)
+            elif client_disconnected:
+                log.info(
+                    "%s %s -> %s (%dms, client disconnected)",
+                    request.method, request.path, response.status, duration_ms
                 )
+            else:
+                log.info("%s %s -> %s (%dms)", request.method, request.path, response.status, duration_ms)
+
+            if cancelled is not None:
+                raise cancelled
+            return client_response
 
     except Exception as e:
-        print(f"Error proxying request: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Error proxying request: %s", e)
+        if client_response is not None and client_response.prepared:
+            # Headers were already sent, so an error response is no longer possible
+            abort_response(request)
+            return client_response
         return web.Response(status=500, text=f"Proxy error: {str(e)}")
 
 
 async def health_check(request: web.Request) -> web.Response:
-    """Health check endpoint."""
+    """Health check endpoint, which also reports background migration progress."""
+    status = request.app['migration']['status']
+    if status == "running":
+        return web.Response(text="migrating")
+    if status.startswith("failed"):
+        return web.Response(status=500, text=f"migration {status}")
     return web.Response(text="OK")
 
 
+async def run_background_migrations(app: web.Application):
+    """Run database migrations while the proxy is already serving requests."""
+    migration = app['migration']
+    migration['status'] = "running"
+    try:
+        await app['logger'].init_db()
+    except asyncio.CancelledError:
+        migration['status'] = "failed: cancelled"
+        raise
+    except Exception as e:
+        migration['status'] = f"failed: {e}"
+    else:
+        migration['status'] = "complete"
+
+
+async def start_background_migrations(app: web.Application):
+    """Start running migrations in the background once the server starts."""
+    app['migration']['task'] = asyncio.create_task(run_background_migrations(app))
+
+
+async def stop_background_migrations(app: web.Application):
+    """Cancel background migrations that are still running on shutdown."""
+    task = app['migration']['task']
+    if not task.done():
+        log.info("Stopping unfinished background migrations")
+        task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+async def close_session(app: web.Application):
+    """Close the shared upstream client session on shutdown."""
+    await app['session'].close()
+
+
+async def wait_for_pending_logs(app: web.Application):
+    """Wait for background log_request() calls to finish on shutdown."""
+    if app['pending_logs']:
+        await asyncio.gather(*app['pending_logs'], return_exceptions=True)
+
+
+async def close_logger(app: web.Application):
+    """Close the request logger's database connection on shutdown."""
+    await app['logger'].close()
+
+
 async def init_app() -> web.Application:
     """Initialize the application."""
     app = web.Application()
 
     # Initialize logger
     logger = ProxyLogger(DB_PATH)
-    await logger.init_db()
+    if MIGRATION_MODE == "sync":
+        await logger.init_db()
+        status = "complete"
+    elif MIGRATION_MODE in ("async", "skip"):
+        await logger.ensure_schema()
+        status = "pending" if MIGRATION_MODE == "async" else "skipped"
+    else:
+        raise ValueError(
+            f"Invalid MIGRATION_MODE {MIGRATION_MODE!r}, expected 'async', 'sync' or 'skip'"
+        )
+    # Mutable, since the application can no longer be modified once it has started
+    app['migration'] = {'status': status, 'task': None}
+    await logger.connect()
     app['logger'] = logger
+    app['pending_logs'] = set()
+    app['log_slots'] = asyncio.Semaphore(MAX_PENDING_LOGS)
+    app.on_cleanup.append(wait_for_pending_logs)
+    app.on_cleanup.append(close_logger)
     app['target_api_url'] = TARGET_API_URL
 
+    if MIGRATION_MODE == "async":
+        app.on_startup.append(start_background_migrations)
+        app.on_shutdown.append(stop_background_migrations)
+
+    # Share one client session across requests so upstream TCP/TLS connections
+    # are kept alive and reused instead of being re-established per request
+    app['session'] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=200, ttl_dns_cache=300)
+    )
+    app.on_cleanup.append(close_session)
+
     # Add routes - catch-all for proxying
     app.router.add_route('*', '/health', health_check)
     app.router.add_route('*', '/{path:.*}', proxy_handler)
@@ -387,11 +897,17 @@ async def init_app() -> web.Application:
 
 def main():
     """Main entry point."""
-    print(f"Starting API logging proxy on port {PROXY_PORT}")
-    print(f"Forwarding to: {TARGET_API_URL}")
-    print(f"Logging to: {DB_PATH}")
+    log_listener = setup_logging()
+    log.info("Starting API logging proxy on port %s", PROXY_PORT)
+    log.info("Forwarding to: %s", TARGET_API_URL)
+    log.info("Logging to: %s", DB_PATH)
+    log.info("Migration mode: %s", MIGRATION_MODE)
 
-    web.run_app(init_app(), host='0.0.0.0', port=PROXY_PORT)
+    try:
+        # Requests are already logged by proxy_handler
+        web.run_app(init_app(), host='0.0.0.0', port=PROXY_PORT, access_log=None)
+    finally:
+        log_listener.stop()
 
 
 if __name__ == '__main__':